@@ -11,47 +11,278 @@ Shows a graph with commit time on horizontal axis and malloc call count on verti
 
 Usage with uv:
     uv run analyze_malloc.py
+    uv run analyze_malloc.py --current   # list malloc calls at HEAD
+    uv run analyze_malloc.py --output malloc.png   # save instead of showing
 
 Usage with standard Python:
     python3 analyze_malloc.py
     (requires: pip install matplotlib)
 """
 
+import argparse
+import atexit
+import functools
+import json
+import os
 import subprocess
 import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 
 
-# Python regex used to COUNT matches in text from git grep.
-# This supports word boundaries and \s.
-MALLOC_REGEX = re.compile(r"\b(malloc|calloc|realloc)\s*\(")
+# Python regex used to COUNT matches in source text.
+# This supports word boundaries; whitespace before "(" may not include a
+# newline, so a whole file is counted the same way git grep counts lines.
+# The names share their "alloc" suffix and are not captured, since only the
+# number of matches is ever used.
+MALLOC_PATTERN = r"\b(?:m|c|re)alloc[^\S\n]*\("
+# Compiled for git grep output lines, and for raw file contents as bytes so
+# they never need to be decoded.
+MALLOC_REGEX = re.compile(MALLOC_PATTERN)
+MALLOC_BYTES_REGEX = re.compile(MALLOC_PATTERN.encode())
 
 # Pattern used for git grep (POSIX ERE, no \s there).
 # [[:space:]] works for spaces/tabs etc.
 GIT_GREP_PATTERN = r"(malloc|calloc|realloc)[[:space:]]*\("
 
+# A `git grep -n <commit>` output line: "<commit>:<path>:<line number>:<text>".
+GIT_GREP_LINE_REGEX = re.compile(r"[^:]*:([^:]+):(\d+):(.*)")
 
-def get_git_commits():
-    """Get list of commits with their commit times and hashes."""
-    # %ct = committer date, UNIX timestamp
+# Directories and file extensions scanned for malloc calls.
+SOURCE_DIRS = ["src", "include"]
+SOURCE_EXTENSIONS = (".c", ".cpp", ".h", ".hpp")
+
+# Tree entry mode of submodules, which have no blob to read.
+GITLINK_MODE = "160000"
+
+# git treats a file as binary if its first 8000 bytes contain a NUL byte.
+BINARY_CHECK_SIZE = 8000
+
+# On-disk cache of malloc counts per commit. Bump CACHE_VERSION whenever the
+# counting rules above change, so old counts are thrown away.
+CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "moss",
+    "malloc_counts.json",
+)
+CACHE_VERSION = 1
+# Counts not used by any of the last CACHE_RUNS runs are dropped.
+CACHE_RUNS = 10
+
+# Commits are counted in parallel; each worker owns one git cat-file process.
+MAX_WORKERS = min(8, os.cpu_count() or 1)
+
+
+class GitCatFile:
+    """
+    Long-running `git cat-file --batch` (or `--batch-check`) process.
+
+    Each object is requested by writing a "<rev>" line to its stdin and read
+    back from its stdout as an "<oid> <type> <size>" header line, followed by
+    the contents unless `batch_check` is set, so looking up any number of
+    objects costs a single git process.
+    """
+
+    def __init__(self, batch_check=False):
+        self.process = subprocess.Popen(
+            ["git", "cat-file", "--batch-check" if batch_check else "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def _request(self, rev):
+        self.process.stdin.write(f"{rev}\n".encode())
+        self.process.stdin.flush()
+
+        # "<rev> missing" / "<rev> ambiguous" have no size field.
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            return None
+
+        return header[0].decode(), header[1].decode(), int(header[2])
+
+    def info(self, rev):
+        """Return (oid, type, size) of `rev`, or None if it is missing."""
+        return self._request(rev)
+
+    def read(self, rev):
+        """Return the contents of `rev` as bytes, or None if it is missing."""
+        header = self._request(rev)
+        if header is None:
+            return None
+
+        size = header[2]
+        contents = self.process.stdout.read(size + 1)
+        return contents[:size]
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+# Commits of the current branch, see get_git_commits().
+_commits_cache = None
+
+# Parsed git grep results, keyed by commit.
+_usages_cache = {}
+
+# Malloc counts per blob object name, shared by all commits that contain it.
+_blob_counts = {}
+
+# Per-thread git cat-file processes.
+_thread_local = threading.local()
+
+
+def get_cat_file(batch_check=False):
+    """
+    Return this thread's `git cat-file --batch` (or `--batch-check`) process,
+    starting it if needed.
+    """
+    name = "batch_check" if batch_check else "batch"
+    cat_file = getattr(_thread_local, name, None)
+    if cat_file is None:
+        cat_file = GitCatFile(batch_check=batch_check)
+        atexit.register(cat_file.close)
+        setattr(_thread_local, name, cat_file)
+    return cat_file
+
+
+class CountCache:
+    """
+    Malloc counts per commit, persisted to CACHE_PATH.
+
+    Commits are immutable, so a count keyed by its commit hash never goes
+    stale. Each entry remembers the last run that used it; entries unused
+    for CACHE_RUNS runs are dropped when the cache is saved.
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.run = 0
+        self.counts = {}
+
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == CACHE_VERSION:
+                self.run = data["run"] + 1
+                self.counts = data["counts"]
+        except (OSError, ValueError, KeyError, TypeError):
+            # Missing or corrupt cache, start from scratch
+            pass
+
+    def get(self, commit_hash):
+        """Return the cached count for `commit_hash`, or None."""
+        entry = self.counts.get(commit_hash)
+        if entry is None:
+            return None
+
+        entry[1] = self.run
+        return entry[0]
+
+    def set(self, commit_hash, count):
+        self.counts[commit_hash] = [count, self.run]
+
+    def save(self):
+        counts = {
+            commit_hash: entry
+            for commit_hash, entry in self.counts.items()
+            if entry[1] > self.run - CACHE_RUNS
+        }
+        data = {"version": CACHE_VERSION, "run": self.run, "counts": counts}
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"[warn] failed to save cache to {self.path}: {e}")
+
+
+class GitError(Exception):
+    """Raised when a git command exits with an unexpected status."""
+
+
+def git_lines(args, ok_returncodes=(0,), input_lines=None):
+    """
+    Run `git <args>` and yield its stdout lines as git produces them.
+
+    Lines are yielded without their trailing newline. If `input_lines` is
+    given, it is written to git's stdin first, for commands that read all of
+    their input before producing output (like `git log --stdin`). Raises
+    GitError with git's stderr once the output is drained if git exits with
+    a status not in `ok_returncodes`.
+    """
+    # stderr goes to a temporary file rather than a pipe: a full stderr pipe
+    # would block git while we are still waiting on its stdout.
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            ["git", *args],
+            stdin=subprocess.PIPE if input_lines is not None else None,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            bufsize=1,
+            encoding="utf-8",
+            errors="replace",
+        )
+
+        with process:
+            if input_lines is not None:
+                for line in input_lines:
+                    process.stdin.write(f"{line}\n")
+                process.stdin.close()
+
+            for line in process.stdout:
+                yield line.rstrip("\n")
+
+        if process.returncode not in ok_returncodes:
+            stderr.seek(0)
+            err = stderr.read().decode("utf-8", errors="replace").strip()
+            raise GitError(err or f"git {args[0]} exited with {process.returncode}")
+
+
+@functools.lru_cache(maxsize=None)
+def get_empty_tree():
+    """Return the object name of the empty tree in this repository."""
     result = subprocess.run(
-        ["git", "log", "--pretty=format:%H|%ct", "--reverse"],
+        ["git", "hash-object", "-t", "tree", "--stdin"],
+        input="",
         capture_output=True,
-        text=True,
+        encoding="utf-8",
+        errors="replace",
         check=True,
     )
+    return result.stdout.strip()
+
+
+def get_git_commits():
+    """
+    Get list of commits with their hashes, commit times and first parents.
+
+    The first parent is None for root commits. git log runs once per
+    process; later calls return the same list.
+    """
+    global _commits_cache
+    if _commits_cache is not None:
+        return _commits_cache
+
+    # %ct = committer date, UNIX timestamp
+    # %P = parent hashes, separated by spaces
+    args = ["log", "--pretty=format:%H|%ct|%P", "--reverse"]
 
     commits = []
-    for line in result.stdout.strip().split("\n"):
+    for line in git_lines(args):
         if not line:
             continue
-        parts = line.split("|", 1)
-        if len(parts) != 2:
+        parts = line.split("|", 2)
+        if len(parts) != 3:
             continue
 
-        commit_hash, ts_str = parts
+        commit_hash, ts_str, parents = parts
         try:
             timestamp = int(ts_str.strip())
             date = datetime.fromtimestamp(timestamp)
@@ -59,64 +290,332 @@ def get_git_commits():
             # Ignore malformed lines
             continue
 
-        commits.append((commit_hash, date))
+        parents = parents.split()
+        first_parent = parents[0] if parents else None
+        commits.append((commit_hash, date, first_parent))
+
+    _commits_cache = commits
+    return commits
+
+
+def get_malloc_changing_commits(commit_hashes, source_dirs=None):
+    """
+    Get the subset of `commit_hashes` whose diff adds or removes a malloc line.
+
+    This is a single git log using git's pickaxe (-G) on just these commits,
+    so an incremental run only diffs the commits missing from the cache.
+    Every other commit has the same malloc count as its first parent, so
+    only these commits (and root commits) need their tree scanned.
+    """
+    if source_dirs is None:
+        source_dirs = SOURCE_DIRS
+
+    # git log command:
+    #   git log --stdin --no-walk -m --full-history --text -G"<pattern>"
+    #       -- <pathspecs...>
+    # --stdin --no-walk shows only the commits written to stdin, without
+    # walking their history.
+    # -m diffs merges against each parent, and --full-history keeps merges
+    # that match one parent but bring malloc changes from the other.
+    # --text makes -G look at files that are (or become) binary, whose
+    # count drops to 0 in count_malloc_in_source.
+    args = [
+        "log",
+        "--stdin",
+        "--no-walk",
+        "-m",
+        "--full-history",
+        "--text",
+        "--pretty=format:%H",
+        f"-G{GIT_GREP_PATTERN}",
+        "--",
+        *source_pathspecs(source_dirs),
+    ]
 
+    commits = set(git_lines(args, input_lines=commit_hashes))
+    commits.discard("")
     return commits
 
 
+def source_pathspecs(source_dirs):
+    """Return git pathspecs matching source files in `source_dirs`."""
+    return [
+        f"{source_dir}/*{extension}"
+        for source_dir in source_dirs
+        for extension in SOURCE_EXTENSIONS
+    ]
+
+
+def get_malloc_usages(commit_hash="HEAD", source_dirs=None):
+    """
+    List malloc/calloc/realloc calls in a specific commit using git grep.
+
+    Returns (path, line number, line) tuples for every line with at least one
+    call. A single git grep is run per commit; its parsed output is cached so
+    listing and counting the same commit share it.
+    """
+    if commit_hash in _usages_cache:
+        return _usages_cache[commit_hash]
+
+    if source_dirs is None:
+        source_dirs = SOURCE_DIRS
+
+    # git grep command:
+    #   git grep -n -E "<pattern>" <commit> -- <pathspecs...>
+    args = [
+        "grep",
+        "-n",
+        "-E",
+        GIT_GREP_PATTERN,
+        commit_hash,
+        "--",
+        *source_pathspecs(source_dirs),
+    ]
+
+    # Parse lines as git grep produces them instead of buffering its output.
+    usages = []
+    try:
+        # git grep exit codes:
+        #   0 = matches found
+        #   1 = no matches
+        #   >1 = real error
+        for line in git_lines(args, ok_returncodes=(0, 1)):
+            match = GIT_GREP_LINE_REGEX.match(line)
+            if match is None:
+                continue
+
+            path, line_number, text = match.group(1, 2, 3)
+            # git grep has no word boundaries, re-check with the Python regex.
+            if MALLOC_REGEX.search(text):
+                usages.append((path, int(line_number), text))
+    except GitError as e:
+        print(f"[warn] git grep failed for {commit_hash}: {e}")
+        return []
+
+    _usages_cache[commit_hash] = usages
+    return usages
+
+
+def count_malloc_in_source(contents):
+    """Count malloc/calloc/realloc calls in the raw contents of a file."""
+    # Every call contains "alloc"; a plain substring search rules out most
+    # files much faster than the regex.
+    if b"alloc" not in contents:
+        return 0
+
+    if b"\0" in contents[:BINARY_CHECK_SIZE]:
+        # git grep only reports "Binary file matches" for these.
+        return 0
+
+    return sum(1 for _ in MALLOC_BYTES_REGEX.finditer(contents))
+
+
 def count_malloc_in_commit(commit_hash, source_dirs=None):
     """
-    Count malloc/calloc/realloc calls in a specific commit using git grep.
+    Count malloc/calloc/realloc calls in a specific commit.
 
-    We use git grep to quickly retrieve candidate lines, then apply a Python
-    regex with word boundaries to count the actual calls.
+    Source files and their blob names are listed with a single git
+    diff-tree. Only blobs not counted before are read, through the calling
+    thread's `git cat-file --batch` process, so files unchanged across
+    commits are counted once.
 
     This correctly counts:
         malloc(sizeof(int));
         malloc (sizeof(int));
         calloc (10, sizeof(int));
         realloc (ptr, new_size);
+
+    Returns None if the commit could not be listed.
     """
     if source_dirs is None:
-        source_dirs = ["src", "include"]
-
-    # git grep command:
-    #   git grep -h -E "<pattern>" <commit> -- <paths...>
-    cmd = [
-        "git",
-        "grep",
-        "-h",  # suppress filenames, only lines
-        "-E",
-        GIT_GREP_PATTERN,
+        source_dirs = SOURCE_DIRS
+
+    # git diff-tree command:
+    #   git diff-tree -r <empty tree> <commit> -- <pathspecs...>
+    # Diffing against the empty tree lists every file in the commit, and
+    # unlike git ls-tree it lets git match the extension globs itself.
+    args = [
+        "diff-tree",
+        "-r",
+        "--no-commit-id",
+        get_empty_tree(),
         commit_hash,
         "--",
-        *source_dirs,
+        *source_pathspecs(source_dirs),
     ]
 
-    result = subprocess.run(
-        cmd,
-        capture_output=True,
-        text=True,
+    # Count each file as soon as git diff-tree lists it.
+    cat_file = get_cat_file()
+    count = 0
+    try:
+        for line in git_lines(args):
+            # Lines look like ":000000 <mode> <null oid> <blob> A\t<path>".
+            fields = line.split("\t", 1)[0].split()
+            if len(fields) != 5 or fields[1] == GITLINK_MODE:
+                continue
+
+            blob = fields[3]
+            blob_count = _blob_counts.get(blob)
+            if blob_count is None:
+                contents = cat_file.read(blob)
+                blob_count = count_malloc_in_source(contents) if contents else 0
+                _blob_counts[blob] = blob_count
+            count += blob_count
+    except GitError as e:
+        print(f"[warn] git diff-tree failed for {commit_hash}: {e}")
+        return None
+
+    return count
+
+
+def get_source_tree_key(batch_check, commit_hash, source_dirs=None):
+    """
+    Return the tree object names of `source_dirs` in a commit.
+
+    Missing directories are None. Two commits with the same key have the
+    same source files, and so the same malloc count.
+    """
+    if source_dirs is None:
+        source_dirs = SOURCE_DIRS
+
+    key = []
+    for source_dir in source_dirs:
+        info = batch_check.info(f"{commit_hash}:{source_dir}")
+        key.append(info[0] if info is not None else None)
+    return tuple(key)
+
+
+def count_malloc_history(commits, cache):
+    """
+    Count malloc calls for every commit in `commits`, in the same order.
+
+    Uncached commits that change malloc lines are scanned in parallel; the
+    rest reuse their first parent's count. Commits whose source trees match
+    their first parent's, or an already scanned commit's, are not scanned.
+
+    Commits that could not be counted are plotted as 0 but never cached, and
+    neither are commits that copy their count.
+    """
+    counts = {}
+    for commit_hash, _, _ in commits:
+        count = cache.get(commit_hash)
+        if count is not None:
+            counts[commit_hash] = count
+
+    first_parents = {
+        commit_hash: first_parent for commit_hash, _, first_parent in commits
+    }
+    missing = [
+        commit_hash for commit_hash, _, _ in commits if commit_hash not in counts
+    ]
+
+    to_scan = []
+    same_tree = {}
+    failed = set()
+    if missing:
+        print("Finding commits that change malloc calls...")
+        changing = get_malloc_changing_commits(missing)
+
+        batch_check = get_cat_file(batch_check=True)
+        tree_keys = {}
+
+        def tree_key(commit_hash):
+            if commit_hash not in tree_keys:
+                tree_keys[commit_hash] = get_source_tree_key(batch_check, commit_hash)
+            return tree_keys[commit_hash]
+
+        scanned_by_tree = {}
+        for commit_hash in missing:
+            first_parent = first_parents[commit_hash]
+            if first_parent is not None and commit_hash not in changing:
+                continue
+
+            key = tree_key(commit_hash)
+            if first_parent is not None and key == tree_key(first_parent):
+                # Only files outside the source dirs differ, reuse the parent
+                continue
+
+            if key in scanned_by_tree:
+                same_tree[commit_hash] = scanned_by_tree[key]
+            elif all(tree is None for tree in key):
+                # No source dirs in this commit at all
+                counts[commit_hash] = 0
+                cache.set(commit_hash, 0)
+            else:
+                scanned_by_tree[key] = commit_hash
+                to_scan.append(commit_hash)
+
+    print(f"Counting malloc calls in {len(to_scan)} commits...")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = executor.map(count_malloc_in_commit, to_scan)
+        for done, (commit_hash, count) in enumerate(zip(to_scan, results), 1):
+            if count is None:
+                failed.add(commit_hash)
+                count = 0
+            else:
+                cache.set(commit_hash, count)
+            counts[commit_hash] = count
+
+            if done % 10 == 0 or done == len(to_scan):
+                print(f"Processed {done}/{len(to_scan)} commits...")
+
+    for commit_hash, scanned_hash in same_tree.items():
+        counts[commit_hash] = counts[scanned_hash]
+        if scanned_hash in failed:
+            failed.add(commit_hash)
+        else:
+            cache.set(commit_hash, counts[scanned_hash])
+
+    for commit_hash in missing:
+        # Walk up first parents to the nearest counted commit, then copy its
+        # count back down the chain.
+        chain = []
+        while commit_hash not in counts:
+            chain.append(commit_hash)
+            commit_hash = first_parents[commit_hash]
+
+        for child_hash in chain:
+            counts[child_hash] = counts[commit_hash]
+            if commit_hash in failed:
+                failed.add(child_hash)
+            else:
+                cache.set(child_hash, counts[commit_hash])
+
+    if failed:
+        print(f"[warn] {len(failed)} commits could not be counted, plotted as 0")
+
+    return [counts[commit_hash] for commit_hash, _, _ in commits]
+
+
+def print_current_malloc_usages():
+    """Print every malloc/calloc/realloc call at HEAD."""
+    usages = get_malloc_usages("HEAD")
+
+    for path, line_number, text in usages:
+        print(f"{path}:{line_number}: {text.strip()}")
+
+    count = sum(
+        1 for _, _, text in usages for _ in MALLOC_REGEX.finditer(text)
     )
+    print(f"\nTotal malloc calls: {count} ({len(usages)} lines)")
 
-    # git grep exit codes:
-    #   0 = matches found
-    #   1 = no matches
-    #   >1 = real error
-    if result.returncode not in (0, 1):
-        err = result.stderr.strip()
-        if err:
-            print(f"[warn] git grep failed for {commit_hash}: {err}")
-        return 0
 
-    if not result.stdout:
-        return 0
+def plot_malloc_history(output=None):
+    """
+    Count malloc calls across the git history and plot them.
+
+    The plot is shown in a window, or saved to `output` if given.
+    """
+    # matplotlib is slow to import and only needed here, not for --current.
+    import matplotlib
 
-    return len(MALLOC_REGEX.findall(result.stdout))
+    if output is not None:
+        # Headless rendering, skips loading a GUI toolkit.
+        matplotlib.use("Agg")
 
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
 
-def main():
-    """Main function to analyze and plot malloc calls."""
     print("Analyzing git history for malloc calls...")
 
     commits = get_git_commits()
@@ -126,17 +625,11 @@ def main():
         print("No commits found!")
         return
 
-    dates = []
-    counts = []
-
-    print("Counting malloc calls per commit...")
-    for i, (commit_hash, date) in enumerate(commits):
-        count = count_malloc_in_commit(commit_hash)
-        dates.append(date)
-        counts.append(count)
+    cache = CountCache()
+    atexit.register(cache.save)
 
-        if (i + 1) % 10 == 0 or i == len(commits) - 1:
-            print(f"Processed {i + 1}/{len(commits)} commits...")
+    dates = [date for _, date, _ in commits]
+    counts = count_malloc_history(commits, cache)
 
     print("Creating plot...")
     fig, ax = plt.subplots(figsize=(12, 6))
@@ -159,7 +652,32 @@ def main():
     print(f"  Minimum malloc calls: {min(counts) if counts else 0}")
     print(f"  Average malloc calls: {sum(counts) / len(counts) if counts else 0:.2f}")
 
-    plt.show()
+    if output is not None:
+        fig.savefig(output, dpi=120)
+        print(f"\nPlot saved to {output}")
+    else:
+        plt.show()
+
+
+def main():
+    """Main function to analyze and plot malloc calls."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--current",
+        action="store_true",
+        help="list malloc calls at HEAD instead of plotting the history",
+    )
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        help="save the plot to FILE (e.g. malloc.png) instead of showing it",
+    )
+    args = parser.parse_args()
+
+    if args.current:
+        print_current_malloc_usages()
+    else:
+        plot_malloc_history(args.output)
 
 
 if __name__ == "__main__":